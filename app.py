@@ -1,9 +1,18 @@
-from flask import Flask, render_template, redirect, url_for, request, session, flash, jsonify, send_from_directory
+from flask import Flask, render_template, redirect, url_for, request, session, flash, jsonify, send_from_directory, g
 from flask_sqlalchemy import SQLAlchemy
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime, timezone
 from functools import wraps
+from collections import Counter, OrderedDict
+import cProfile
+import hmac
+import json
+import math
 import os
+import random
+import sys
+import threading
+import time
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'jungle-survival-secret-key-change-in-production')
@@ -16,6 +25,15 @@ if database_url.startswith('postgres://'):
 app.config['SQLALCHEMY_DATABASE_URI'] = database_url
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
+# On-demand request profiling (off unless PROFILE_ENABLED=1)
+app.config['PROFILE_ENABLED'] = os.environ.get('PROFILE_ENABLED') == '1'
+app.config['PROFILE_TOKEN'] = os.environ.get('PROFILE_TOKEN', '')
+app.config['PROFILE_DIR'] = os.environ.get('PROFILE_DIR', os.path.join(app.instance_path, 'profiles'))
+app.config['PROFILE_SAMPLE_RATE'] = int(os.environ.get('PROFILE_SAMPLE_RATE', '0'))  # profile ~1 in N requests, 0 = never
+app.config['PROFILE_INTERVAL'] = float(os.environ.get('PROFILE_INTERVAL', '0.005'))  # seconds between stack samples
+app.config['PROFILE_MODE'] = os.environ.get('PROFILE_MODE', 'sample')  # 'sample' or 'cprofile' for token-triggered requests
+app.config['PROFILE_MAX_FILES'] = int(os.environ.get('PROFILE_MAX_FILES', '200'))  # oldest profiles pruned past this
+
 db = SQLAlchemy(app)
 
 # ── Favicon ────────────────────────────────────────────────
@@ -30,6 +48,10 @@ def favicon():
 CATEGORIES = ['Rations', 'Shelter', 'Tools', 'Medicine', 'Expedition', 'Signal', 'Supplies', 'Other']
 DEFAULT_BUDGET = 30000
 
+# Survival % floors for each meter level, highest first; below the last floor is 'critical'
+METER_THRESHOLDS = [(60, 'green'), (30, 'yellow'), (10, 'red')]
+METER_LEVELS = [level for _, level in METER_THRESHOLDS] + ['critical']
+
 DEMO_EXPENSES = [
     {'id': 1, 'description': 'Base Camp Groceries', 'amount': 4200, 'category': 'Rations', 'date': '2025-07-03'},
     {'id': 2, 'description': 'Rent & Utilities', 'amount': 9500, 'category': 'Shelter', 'date': '2025-07-01'},
@@ -44,6 +66,7 @@ class User(db.Model):
     password_hash = db.Column(db.String(200), nullable=False)
     monthly_budget = db.Column(db.Float, default=DEFAULT_BUDGET)
     expenses = db.relationship('Expense', backref='user', lazy=True, cascade='all, delete-orphan')
+    category_budgets = db.relationship('CategoryBudget', backref='user', lazy=True, cascade='all, delete-orphan')
 
     def set_password(self, password):
         self.password_hash = generate_password_hash(password)
@@ -51,29 +74,6 @@ class User(db.Model):
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
 
-    def survival_pct(self):
-        now = datetime.now(timezone.utc)
-        month_expenses = Expense.query.filter(
-            Expense.user_id == self.id,
-            db.extract('month', Expense.date) == now.month,
-            db.extract('year', Expense.date) == now.year
-        ).all()
-        total_spent = sum(e.amount for e in month_expenses)
-        if self.monthly_budget <= 0:
-            return 0
-        spent_pct = (total_spent / self.monthly_budget) * 100
-        survival = max(0, 100 - spent_pct)
-        return round(survival, 1)
-
-    def current_month_spent(self):
-        now = datetime.now(timezone.utc)
-        month_expenses = Expense.query.filter(
-            Expense.user_id == self.id,
-            db.extract('month', Expense.date) == now.month,
-            db.extract('year', Expense.date) == now.year
-        ).all()
-        return sum(e.amount for e in month_expenses)
-
 class Expense(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     description = db.Column(db.String(200), nullable=False)
@@ -82,6 +82,261 @@ class Expense(db.Model):
     date = db.Column(db.DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
 
+class CategoryBudget(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    category = db.Column(db.String(50), nullable=False)
+    amount = db.Column(db.Float, nullable=False)
+    __table_args__ = (db.UniqueConstraint('user_id', 'category'),)
+
+class MonthlyRollup(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    year = db.Column(db.Integer, nullable=False)
+    month = db.Column(db.Integer, nullable=False)
+    category = db.Column(db.String(50), nullable=False)
+    spent = db.Column(db.Float, nullable=False, default=0)
+    budget = db.Column(db.Float)
+    __table_args__ = (db.UniqueConstraint('user_id', 'year', 'month', 'category'),)
+
+class Job(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    payload = db.Column(db.Text, nullable=False, default='{}')
+    status = db.Column(db.String(20), nullable=False, default='queued', index=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=3)
+    dedupe_key = db.Column(db.String(100), unique=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    result = db.Column(db.Text)
+    error = db.Column(db.Text)
+    run_at = db.Column(db.DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
+    created_at = db.Column(db.DateTime(timezone=True), default=lambda: datetime.now(timezone.utc))
+    started_at = db.Column(db.DateTime(timezone=True))
+    finished_at = db.Column(db.DateTime(timezone=True))
+    worker_id = db.Column(db.String(100))  # worker process running the job
+    heartbeat_at = db.Column(db.DateTime(timezone=True))  # refreshed by that worker while it is alive
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'attempts': self.attempts,
+            'max_attempts': self.max_attempts,
+            'result': json.loads(self.result) if self.result else None,
+            'error': self.error,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+        }
+
+# ── Budget envelopes ───────────────────────────────────────
+# Per-user, per-month envelope state kept in process memory. It is built from
+# one grouped aggregate and then patched by add/delete to detect threshold
+# crossings without rescanning. Each gunicorn worker holds its own copy, so the
+# cache is never the source of truth for amounts shown to the user: states
+# expire after ENVELOPE_TTL seconds to pick up other workers' writes, and the
+# meter reads spending from a fresh grouped SUM. All access to the cache and the
+# states in it goes through the lock; the least recently used users are evicted
+# past ENVELOPE_CACHE_SIZE.
+ENVELOPE_CACHE_SIZE = int(os.environ.get('ENVELOPE_CACHE_SIZE', '1000'))
+ENVELOPE_TTL = int(os.environ.get('ENVELOPE_TTL', '300'))
+_envelopes = OrderedDict()
+_envelopes_lock = threading.Lock()
+
+def meter_level(survival):
+    for floor, level in METER_THRESHOLDS:
+        if survival > floor:
+            return level
+    return 'critical'
+
+def _survival(spent, budget):
+    if budget <= 0:
+        return 0
+    return round(max(0, 100 - spent / budget * 100), 1)
+
+def _month_key(dt):
+    return (dt.year, dt.month)
+
+def previous_month(year, month):
+    return (year, month - 1) if month > 1 else (year - 1, 12)
+
+def month_category_spent(user_id, now):
+    """Current month's spending per category, as one grouped SUM."""
+    rows = db.session.query(Expense.category, db.func.sum(Expense.amount)).filter(
+        Expense.user_id == user_id,
+        db.extract('month', Expense.date) == now.month,
+        db.extract('year', Expense.date) == now.year
+    ).group_by(Expense.category).all()
+    return {category: total or 0 for category, total in rows}
+
+def _load_envelopes(user_id, now):
+    budgets = {b.category: b.amount for b in CategoryBudget.query.filter_by(user_id=user_id)}
+    spent = month_category_spent(user_id, now)
+    levels = {cat: meter_level(_survival(spent.get(cat, 0), amount)) for cat, amount in budgets.items()}
+    return {'month': _month_key(now), 'loaded_at': time.monotonic(),
+            'budgets': budgets, 'spent': spent, 'levels': levels}
+
+def _envelopes_fresh(state, now):
+    return (state is not None and state['month'] == _month_key(now)
+            and time.monotonic() - state['loaded_at'] < ENVELOPE_TTL)
+
+def get_envelopes(user_id):
+    now = datetime.now(timezone.utc)
+    with _envelopes_lock:
+        state = _envelopes.get(user_id)
+        if _envelopes_fresh(state, now):
+            _envelopes.move_to_end(user_id)
+            return state
+    loaded = _load_envelopes(user_id, now)
+    with _envelopes_lock:
+        # Another request may have stored (and since patched) a state while we
+        # were loading; keep it rather than overwrite it with our snapshot
+        state = _envelopes.get(user_id)
+        if not _envelopes_fresh(state, now):
+            state = _envelopes[user_id] = loaded
+        _envelopes.move_to_end(user_id)
+        while len(_envelopes) > ENVELOPE_CACHE_SIZE:
+            _envelopes.popitem(last=False)
+    return state
+
+def envelope_budgets(user_id):
+    state = get_envelopes(user_id)
+    with _envelopes_lock:
+        return dict(state['budgets'])
+
+def invalidate_envelopes(user_id):
+    with _envelopes_lock:
+        _envelopes.pop(user_id, None)
+
+def apply_expense_delta(state, category, amount, when):
+    """Fold one added (+) or removed (-) expense into an envelope state.
+
+    The state must be fetched before the change is committed, otherwise a
+    fresh load would already include it. Returns an alert message when the
+    change pushes the category's envelope into a worse meter level.
+    """
+    if when is None or _month_key(when) != state['month']:
+        return None
+    with _envelopes_lock:
+        state['spent'][category] = max(0, state['spent'].get(category, 0) + amount)
+        budget = state['budgets'].get(category)
+        if budget is None:
+            return None
+        old_level = state['levels'].get(category, 'green')
+        survival = _survival(state['spent'][category], budget)
+        new_level = meter_level(survival)
+        state['levels'][category] = new_level
+    if METER_LEVELS.index(new_level) > METER_LEVELS.index(old_level):
+        return f'{category} envelope dropped to {new_level.upper()}: {survival}% left of ₹{budget:,.0f}.'
+    return None
+
+def envelope_status(budgets, spent_by_category):
+    status = []
+    for cat in CATEGORIES:
+        budget = budgets.get(cat)
+        if budget is None:
+            continue
+        spent = spent_by_category.get(cat, 0)
+        survival = _survival(spent, budget)
+        status.append({
+            'category': cat,
+            'budget': budget,
+            'spent': spent,
+            'remaining': budget - spent,
+            'survival_pct': survival,
+            'level': meter_level(survival),
+        })
+    return status
+
+# ── Background jobs ────────────────────────────────────────
+# Heavy work is queued in the job table and executed by worker.py, off the
+# request thread. Handlers take the job payload as keyword arguments and return
+# a JSON-serialisable result.
+ROLLUP_BATCH_SIZE = int(os.environ.get('ROLLUP_BATCH_SIZE', '500'))
+
+def enqueue_job(kind, payload=None, user_id=None, dedupe_key=None):
+    """Queue a job; returns None if a job with the same dedupe_key already exists."""
+    if dedupe_key and Job.query.filter_by(dedupe_key=dedupe_key).first():
+        return None
+    job = Job(kind=kind, payload=json.dumps(payload or {}), user_id=user_id, dedupe_key=dedupe_key)
+    db.session.add(job)
+    try:
+        db.session.commit()
+    except db.exc.IntegrityError:
+        db.session.rollback()
+        return None
+    return job
+
+def enqueue_once(kind, payload, user_id=None):
+    """Queue a job unless an identical one is still waiting to run."""
+    pending = Job.query.filter_by(kind=kind, payload=json.dumps(payload), status='queued').first()
+    return pending or enqueue_job(kind, payload, user_id=user_id)
+
+def close_month(year, month, user_ids=None):
+    """Write per-category MonthlyRollup rows for one month, in batches of users."""
+    if user_ids is None:
+        user_ids = [uid for (uid,) in db.session.query(User.id).order_by(User.id)]
+    rows_written = 0
+    for i in range(0, len(user_ids), ROLLUP_BATCH_SIZE):
+        batch = user_ids[i:i + ROLLUP_BATCH_SIZE]
+        totals = db.session.query(Expense.user_id, Expense.category, db.func.sum(Expense.amount)).filter(
+            Expense.user_id.in_(batch),
+            db.extract('month', Expense.date) == month,
+            db.extract('year', Expense.date) == year
+        ).group_by(Expense.user_id, Expense.category).all()
+        budgets = {(b.user_id, b.category): b.amount
+                   for b in CategoryBudget.query.filter(CategoryBudget.user_id.in_(batch))}
+        MonthlyRollup.query.filter(
+            MonthlyRollup.user_id.in_(batch),
+            MonthlyRollup.year == year,
+            MonthlyRollup.month == month
+        ).delete(synchronize_session=False)
+        rows = [{'user_id': uid, 'year': year, 'month': month, 'category': cat,
+                 'spent': total or 0, 'budget': budgets.get((uid, cat))}
+                for uid, cat, total in totals]
+        if rows:
+            db.session.execute(db.insert(MonthlyRollup), rows)
+        db.session.commit()
+        rows_written += len(rows)
+    return {'year': year, 'month': month, 'users': len(user_ids), 'rows': rows_written}
+
+def rebuild_rollups(user_id):
+    """Recompute every past month's rollups for one user."""
+    now = datetime.now(timezone.utc)
+    months = db.session.query(
+        db.extract('year', Expense.date), db.extract('month', Expense.date)
+    ).filter(Expense.user_id == user_id).distinct().all()
+    rebuilt = []
+    for year, month in sorted((int(y), int(m)) for y, m in months):
+        if (year, month) < _month_key(now):
+            close_month(year, month, user_ids=[user_id])
+            rebuilt.append(f'{year}-{month:02d}')
+    return {'months': rebuilt}
+
+def month_history(user_id, limit=12):
+    """The user's most recent closed months, newest first, read from MonthlyRollup."""
+    months = db.session.query(MonthlyRollup.year, MonthlyRollup.month).filter(
+        MonthlyRollup.user_id == user_id
+    ).distinct().order_by(MonthlyRollup.year.desc(), MonthlyRollup.month.desc()).limit(limit).all()
+    if not months:
+        return []
+    oldest = months[-1].year * 12 + months[-1].month
+    history = {(m.year, m.month): {'year': m.year, 'month': m.month, 'spent': 0, 'categories': {}} for m in months}
+    for row in MonthlyRollup.query.filter(
+        MonthlyRollup.user_id == user_id,
+        MonthlyRollup.year * 12 + MonthlyRollup.month >= oldest
+    ):
+        entry = history[(row.year, row.month)]
+        entry['spent'] += row.spent
+        entry['categories'][row.category] = {'spent': row.spent, 'budget': row.budget}
+    return [history[(m.year, m.month)] for m in months]
+
+JOB_HANDLERS = {
+    'month_close': close_month,
+    'rebuild_rollups': rebuild_rollups,
+}
+
 def login_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
@@ -91,6 +346,137 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated
 
+# ── Request profiling ──────────────────────────────────────
+# A profiled request runs under exactly one profiler:
+#   sample   – a side thread samples the request thread's stack, saved as
+#              .collapsed for flamegraph.pl / speedscope. Low overhead, safe on
+#              live traffic, and the only mode used for random sampling.
+#   cprofile – deterministic cProfile, saved as .prof for pstats / snakeviz.
+#              Exact call counts, but inflates Python-heavy frames.
+# Triggered by PROFILE_TOKEN in an X-Profile-Token header (mode chosen with
+# X-Profile-Mode, default PROFILE_MODE), or at random for 1 in
+# PROFILE_SAMPLE_RATE requests. The ?_profile=<token> query flag is honoured in
+# debug mode only, so the token never ends up in production URLs or logs.
+PROFILE_MODES = ('sample', 'cprofile')
+
+class StackSampler(threading.Thread):
+    def __init__(self, thread_id, interval):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+def _profile_requested():
+    token = app.config['PROFILE_TOKEN']
+    if not token:
+        return False
+    given = request.headers.get('X-Profile-Token', '')
+    if not given and app.debug:
+        given = request.args.get('_profile', '')
+    return hmac.compare_digest(given.encode(), token.encode())
+
+def _profile_sampled():
+    rate = app.config['PROFILE_SAMPLE_RATE']
+    return rate > 0 and random.randrange(rate) == 0
+
+# Running count of saved profiles in this process; the directory is only listed
+# and pruned once it goes over PROFILE_MAX_FILES, and then cut back by a tenth
+# so the next prune is a while away.
+_profile_count = None
+_profile_count_lock = threading.Lock()
+
+def _profile_files(out_dir):
+    return [os.path.join(out_dir, name) for name in os.listdir(out_dir)
+            if name.endswith(('.prof', '.collapsed'))]
+
+def _prune_profiles(out_dir):
+    global _profile_count
+    limit = app.config['PROFILE_MAX_FILES']
+    with _profile_count_lock:
+        if _profile_count is None:
+            _profile_count = len(_profile_files(out_dir))
+        else:
+            _profile_count += 1
+        if _profile_count <= limit:
+            return
+        files = sorted(_profile_files(out_dir), key=os.path.getmtime)
+        keep = limit - limit // 10
+        for path in files[:max(0, len(files) - keep)]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        _profile_count = min(len(files), keep)
+
+@app.before_request
+def start_profiling():
+    if not app.config['PROFILE_ENABLED']:
+        return
+    if _profile_requested():
+        mode = request.headers.get('X-Profile-Mode', app.config['PROFILE_MODE'])
+    elif _profile_sampled():
+        mode = 'sample'
+    else:
+        return
+    if mode not in PROFILE_MODES:
+        mode = 'sample'
+    g.profile_started = time.perf_counter()
+    if mode == 'cprofile':
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+            g.profiler = profiler
+            return
+        except ValueError:
+            # Python 3.12+ allows one active cProfile per process; sample instead
+            app.logger.info('cProfile busy, sampling %s %s instead', request.method, request.path)
+    g.profiler = StackSampler(threading.get_ident(), app.config['PROFILE_INTERVAL'])
+    g.profiler.start()
+
+@app.teardown_request
+def stop_profiling(exc):
+    profiler = g.pop('profiler', None)
+    if profiler is None:
+        return
+    if isinstance(profiler, cProfile.Profile):
+        profiler.disable()
+    else:
+        profiler.stop()
+    elapsed_ms = (time.perf_counter() - g.pop('profile_started')) * 1000
+    try:
+        out_dir = app.config['PROFILE_DIR']
+        os.makedirs(out_dir, exist_ok=True)
+        stamp = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%f')
+        base = os.path.join(out_dir, f'{stamp}-{request.endpoint or "unknown"}-{elapsed_ms:.0f}ms')
+        if isinstance(profiler, cProfile.Profile):
+            path = base + '.prof'
+            profiler.dump_stats(path)
+        else:
+            path = base + '.collapsed'
+            with open(path, 'w') as f:
+                for stack, count in profiler.stacks.items():
+                    f.write(f'{stack} {count}\n')
+        _prune_profiles(out_dir)
+        app.logger.info('Profiled %s %s in %.0fms -> %s', request.method, request.path, elapsed_ms, path)
+    except OSError:
+        app.logger.exception('Could not save request profile')
+
 @app.route('/')
 def index():
     return render_template('landing.html')
@@ -171,13 +557,23 @@ def dashboard():
         db.extract('month', Expense.date) == now.month,
         db.extract('year', Expense.date) == now.year
     ).order_by(Expense.date.desc()).all()
-    total_spent = sum(e.amount for e in expenses)
-    survival_pct = user.survival_pct()
+    spent_by_category = {}
+    for e in expenses:
+        spent_by_category[e.category] = spent_by_category.get(e.category, 0) + e.amount
+    total_spent = sum(spent_by_category.values())
+    survival_pct = _survival(total_spent, user.monthly_budget)
+    envelopes = envelope_status(envelope_budgets(user.id), spent_by_category)
+    history = month_history(user.id, limit=1)
+    if history and (history[0]['year'], history[0]['month']) != previous_month(now.year, now.month):
+        history = []
     return render_template('dashboard.html',
                            user=user,
                            expenses=expenses,
                            total_spent=total_spent,
                            survival_pct=survival_pct,
+                           envelopes=envelopes,
+                           last_month=history[0] if history else None,
+                           thresholds=METER_THRESHOLDS,
                            categories=CATEGORIES,
                            now=now)
 
@@ -208,9 +604,13 @@ def add_expense():
         category=category,
         user_id=session['user_id']
     )
+    envelopes = get_envelopes(session['user_id'])
     db.session.add(expense)
     db.session.commit()
     flash(f'Expense logged: {description} (₹{amount:,.0f})', 'success')
+    alert = apply_expense_delta(envelopes, category, amount, expense.date)
+    if alert:
+        flash(alert, 'warning')
     return redirect(url_for('dashboard'))
 
 @app.route('/delete/<int:expense_id>', methods=['POST'])
@@ -220,8 +620,15 @@ def delete_expense(expense_id):
     if not expense:
         flash('Expense not found.', 'danger')
         return redirect(url_for('dashboard'))
+    envelopes = get_envelopes(session['user_id'])
+    category, amount, when = expense.category, expense.amount, expense.date
     db.session.delete(expense)
     db.session.commit()
+    apply_expense_delta(envelopes, category, -amount, when)
+    if when is not None and _month_key(when) < _month_key(datetime.now(timezone.utc)):
+        # The month is already closed; refresh its rollup off the request path
+        enqueue_once('month_close', {'year': when.year, 'month': when.month,
+                                     'user_ids': [session['user_id']]}, user_id=session['user_id'])
     flash('Expense removed from the log.', 'success')
     return redirect(url_for('dashboard'))
 
@@ -233,15 +640,35 @@ def settings():
         budget_str = request.form.get('monthly_budget', '').strip()
         try:
             budget = float(budget_str)
-            if budget <= 0:
+            if not math.isfinite(budget) or budget <= 0:
                 raise ValueError
+            envelopes = {}
+            for cat in CATEGORIES:
+                cat_str = request.form.get(f'budget_{cat}', '').strip()
+                if cat_str:
+                    envelopes[cat] = float(cat_str)
+                    if not math.isfinite(envelopes[cat]) or envelopes[cat] <= 0:
+                        raise ValueError
             user.monthly_budget = budget
+            existing = {b.category: b for b in user.category_budgets}
+            for cat, row in existing.items():
+                if cat not in envelopes:
+                    db.session.delete(row)
+            for cat, amount in envelopes.items():
+                if cat in existing:
+                    existing[cat].amount = amount
+                else:
+                    db.session.add(CategoryBudget(user_id=user.id, category=cat, amount=amount))
             db.session.commit()
+            invalidate_envelopes(user.id)
             flash('Budget updated. Survive harder.', 'success')
         except ValueError:
             flash('Invalid budget amount.', 'danger')
         return redirect(url_for('settings'))
-    return render_template('settings.html', user=user)
+    category_budgets = {b.category: b.amount for b in user.category_budgets}
+    return render_template('settings.html', user=user,
+                           categories=CATEGORIES,
+                           category_budgets=category_budgets)
 
 @app.route('/logout')
 @login_required
@@ -254,15 +681,44 @@ def logout():
 @login_required
 def api_meter():
     user = db.session.get(User, session['user_id'])
-    pct = user.survival_pct()
-    spent = user.current_month_spent()
+    spent_by_category = month_category_spent(user.id, datetime.now(timezone.utc))
+    spent = sum(spent_by_category.values())
+    pct = _survival(spent, user.monthly_budget)
     return jsonify({
         'survival_pct': pct,
+        'level': meter_level(pct),
         'spent': spent,
         'budget': user.monthly_budget,
-        'remaining': user.monthly_budget - spent
+        'remaining': user.monthly_budget - spent,
+        'envelopes': envelope_status(envelope_budgets(user.id), spent_by_category)
     })
 
+@app.route('/api/jobs/rollups', methods=['POST'])
+@login_required
+def api_rebuild_rollups():
+    pending = Job.query.filter(
+        Job.kind == 'rebuild_rollups',
+        Job.user_id == session['user_id'],
+        Job.status.in_(['queued', 'running'])
+    ).first()
+    if pending:
+        return jsonify(pending.to_dict()), 200
+    job = enqueue_job('rebuild_rollups', {'user_id': session['user_id']}, user_id=session['user_id'])
+    return jsonify(job.to_dict()), 202
+
+@app.route('/api/history')
+@login_required
+def api_history():
+    return jsonify({'months': month_history(session['user_id'])})
+
+@app.route('/api/jobs/<int:job_id>')
+@login_required
+def api_job_status(job_id):
+    job = Job.query.filter_by(id=job_id, user_id=session['user_id']).first()
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job.to_dict())
+
 with app.app_context():
     db.create_all()
 
@@ -0,0 +1,247 @@
+"""Background job worker: `python worker.py`
+
+Polls the job table, runs claimed jobs on a process pool, retries failures
+with exponential backoff and enqueues periodic jobs (month close).
+"""
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta, timezone
+import json
+import os
+import socket
+import time
+
+from app import app, db, Job, JOB_HANDLERS, enqueue_job, previous_month
+
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', '2'))
+JOB_POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL', '2'))
+JOB_RETRY_DELAY = int(os.environ.get('JOB_RETRY_DELAY', '30'))  # seconds, doubled per attempt
+JOB_TIMEOUT = int(os.environ.get('JOB_TIMEOUT', '1800'))  # a job running longer is killed and charged an attempt
+JOB_HEARTBEAT_TIMEOUT = int(os.environ.get('JOB_HEARTBEAT_TIMEOUT', '120'))  # silent workers' jobs are reclaimed
+JOB_CATCHUP_MONTHS = int(os.environ.get('JOB_CATCHUP_MONTHS', '3'))  # recent months the scheduler keeps closed
+JOB_RESCHEDULE_DELAY = int(os.environ.get('JOB_RESCHEDULE_DELAY', '3600'))  # wait before rescheduling a failed close
+
+WORKER_ID = f'{socket.gethostname()}:{os.getpid()}'
+
+
+def _init_child():
+    # Connections inherited from the parent must not be shared across processes
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+
+def _new_pool():
+    return ProcessPoolExecutor(max_workers=JOB_WORKERS, initializer=_init_child)
+
+
+def _kill_pool(pool):
+    # A running future cannot be cancelled, so hung jobs are stopped by
+    # terminating the pool's processes outright
+    for process in list((pool._processes or {}).values()):
+        process.terminate()
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def execute_job(kind, payload):
+    """Runs inside a pool process."""
+    with app.app_context():
+        return JOB_HANDLERS[kind](**json.loads(payload))
+
+
+def schedule_periodic_jobs(now):
+    """Keep the last JOB_CATCHUP_MONTHS months closed.
+
+    A month with a queued, running or finished month_close is skipped through
+    its dedupe key, so this also catches up months that passed while the worker
+    was down. A failed close frees the key and is rescheduled once
+    JOB_RESCHEDULE_DELAY has passed.
+    """
+    year, month = now.year, now.month
+    for _ in range(JOB_CATCHUP_MONTHS):
+        year, month = previous_month(year, month)
+        payload = {'year': year, 'month': month}
+        recently_failed = Job.query.filter(
+            Job.kind == 'month_close',
+            Job.payload == json.dumps(payload),
+            Job.status == 'failed',
+            Job.finished_at > now - timedelta(seconds=JOB_RESCHEDULE_DELAY)
+        ).first()
+        if not recently_failed:
+            enqueue_job('month_close', payload, dedupe_key=f'month_close:{year}-{month:02d}')
+
+
+def record_failure(job, error, now):
+    """Charge the current attempt to the job: retry with backoff, or fail it for good."""
+    job.error = error
+    if job.attempts < job.max_attempts:
+        job.status = 'queued'
+        job.run_at = now + timedelta(seconds=JOB_RETRY_DELAY * 2 ** (job.attempts - 1))
+    else:
+        job.status = 'failed'
+        job.finished_at = now
+        job.dedupe_key = None  # let the scheduler queue this work again later
+    app.logger.warning('Job %s (%s) attempt %s failed: %s', job.id, job.kind, job.attempts, error)
+
+
+def release_job(job, now):
+    """Put a job back in the queue without charging the attempt it was on."""
+    job.status = 'queued'
+    job.attempts = max(0, job.attempts - 1)
+    job.run_at = now
+
+
+def heartbeat(now, running_ids):
+    if running_ids:
+        Job.query.filter(Job.id.in_(running_ids), Job.worker_id == WORKER_ID).update(
+            {'heartbeat_at': now}, synchronize_session=False)
+        db.session.commit()
+
+
+def reclaim_orphaned_jobs(now, running_ids):
+    """Charge jobs whose worker has stopped sending heartbeats."""
+    orphaned = Job.query.filter(
+        Job.status == 'running',
+        Job.heartbeat_at < now - timedelta(seconds=JOB_HEARTBEAT_TIMEOUT),
+        Job.id.notin_(running_ids)
+    ).all()
+    for job in orphaned:
+        record_failure(job, f'Worker {job.worker_id} stopped responding', now)
+    db.session.commit()
+
+
+def claim_jobs(now, limit, only_ids=None):
+    claimed = []
+    if limit <= 0:
+        return claimed
+    query = Job.query.filter(Job.status == 'queued', Job.run_at <= now)
+    if only_ids is not None:
+        query = query.filter(Job.id.in_(only_ids))
+    candidates = query.order_by(Job.run_at, Job.id).limit(limit).all()
+    for job in candidates:
+        # Conditional update so two workers never pick up the same job
+        won = Job.query.filter_by(id=job.id, status='queued').update(
+            {'status': 'running', 'started_at': now, 'attempts': Job.attempts + 1,
+             'worker_id': WORKER_ID, 'heartbeat_at': now},
+            synchronize_session=False)
+        db.session.commit()
+        if won:
+            claimed.append(db.session.get(Job, job.id))
+    return claimed
+
+
+def finish_job(job_id, future):
+    job = db.session.get(Job, job_id)
+    now = datetime.now(timezone.utc)
+    try:
+        job.result = json.dumps(future.result())
+        job.status = 'done'
+        job.error = None
+        job.finished_at = now
+    except Exception as exc:
+        record_failure(job, f'{type(exc).__name__}: {exc}', now)
+    db.session.commit()
+
+
+def handle_broken_pool(job_ids, suspects):
+    """A pool process died, taking every in-flight job down with it.
+
+    With a single job in flight it is the culprit and is charged the attempt.
+    Otherwise nobody can be blamed yet: all of them are released and become
+    suspects, which are then re-run one at a time so a crash is attributable.
+    """
+    now = datetime.now(timezone.utc)
+    jobs = [db.session.get(Job, job_id) for job_id in job_ids]
+    if not jobs:
+        return
+    if len(jobs) == 1:
+        record_failure(jobs[0], 'Worker process died', now)
+        suspects.discard(jobs[0].id)
+    else:
+        for job in jobs:
+            release_job(job, now)
+            suspects.add(job.id)
+        app.logger.warning('Worker pool crashed with jobs %s in flight; re-running them one at a time', job_ids)
+    db.session.commit()
+
+
+def restart_pool(pool, running, suspects):
+    broken_ids = [job_id for job_id, _ in running.values()]
+    running.clear()
+    pool.shutdown(wait=False, cancel_futures=True)
+    handle_broken_pool(broken_ids, suspects)
+    return _new_pool()
+
+
+def recycle_timed_out(pool, running, expired, suspects):
+    """Kill the pool to stop jobs past their deadline, charging only those jobs."""
+    now = datetime.now(timezone.utc)
+    for future, (job_id, _) in running.items():
+        job = db.session.get(Job, job_id)
+        if future in expired:
+            record_failure(job, f'Timed out after {JOB_TIMEOUT}s', now)
+            suspects.discard(job_id)
+        else:
+            release_job(job, now)
+    db.session.commit()
+    running.clear()
+    _kill_pool(pool)
+    return _new_pool()
+
+
+def run():
+    running = {}  # future -> (job id, monotonic deadline)
+    suspects = set()
+    pool = _new_pool()
+    try:
+        while True:
+            with app.app_context():
+                try:
+                    now = datetime.now(timezone.utc)
+                    running_ids = [job_id for job_id, _ in running.values()]
+                    heartbeat(now, running_ids)
+                    schedule_periodic_jobs(now)
+                    reclaim_orphaned_jobs(now, running_ids)
+
+                    broken = False
+                    for future in [f for f in running if f.done()]:
+                        if isinstance(future.exception(), BrokenProcessPool):
+                            broken = True
+                            continue
+                        job_id, _ = running.pop(future)
+                        finish_job(job_id, future)
+                        suspects.discard(job_id)
+                    if broken:
+                        pool = restart_pool(pool, running, suspects)
+                    else:
+                        expired = {f for f, (_, deadline) in running.items() if time.monotonic() > deadline}
+                        if expired:
+                            pool = recycle_timed_out(pool, running, expired, suspects)
+
+                    if suspects:
+                        # Drop suspects that finished or were picked up elsewhere
+                        suspects &= {job.id for job in Job.query.filter(
+                            Job.id.in_(suspects), Job.status == 'queued')} | {job_id for job_id, _ in running.values()}
+                    if suspects:
+                        claimed = claim_jobs(now, 1 - len(running), only_ids=suspects)
+                    else:
+                        claimed = claim_jobs(now, JOB_WORKERS - len(running))
+                    for i, job in enumerate(claimed):
+                        try:
+                            future = pool.submit(execute_job, job.kind, job.payload)
+                            running[future] = (job.id, time.monotonic() + JOB_TIMEOUT)
+                        except BrokenProcessPool:
+                            for unsent in claimed[i:]:
+                                release_job(unsent, now)
+                            db.session.commit()
+                            pool = restart_pool(pool, running, suspects)
+                            break
+                except Exception:
+                    db.session.rollback()
+                    app.logger.exception('Job worker loop failed; retrying')
+            time.sleep(JOB_POLL_INTERVAL)
+    finally:
+        _kill_pool(pool)
+
+
+if __name__ == '__main__':
+    run()